@@ -1,32 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 import hashlib
 import json
 import logging
-import multiprocessing
+import mmap
 import os
 import os.path
 import re
+import shutil
 import sys
 import sqlite3
 import subprocess
 import tempfile
 import time
-from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 
+schema_version = 3
+
 schema = """
 CREATE TABLE IF NOT EXISTS builds (
-  id INTEGER PRIMARY KEY
-  , key BLOB NOT NULL
-  , value BLOB NOT NULL
+  key BLOB PRIMARY KEY
+  , obj_sha BLOB NOT NULL
   , last_used INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
-  , UNIQUE(key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS file_hashes (
+  path TEXT PRIMARY KEY
+  , mtime INTEGER NOT NULL
+  , size INTEGER NOT NULL
+  , sha BLOB NOT NULL
 );
 """
 
 
+def new_hash(data: bytes = b""):
+    return hashlib.blake2b(data, digest_size=32)
+
+
 class Config:
 
     def __init__(self, cflags: Optional[List[str]] = None, ldflags: Optional[List[str]] = None):
@@ -36,7 +50,7 @@ class Config:
 
     def hash(self):
         if self._hash is None:
-            m = hashlib.sha256()
+            m = new_hash()
             for val in sorted(set(self.cflags)):
                 m.update(val.encode("utf-8"))
             for val in sorted(set(self.ldflags)):
@@ -47,11 +61,12 @@ class Config:
 
 
 class Source:
-    re_local = re.compile(r"#include\s+\"(.*)\"")
+    re_local = re.compile(r"#include[ \t]+\"(.*)\"")
 
     def __init__(self, filename: str, local, target=None):
         self.filename = filename
         self.local = set(local)
+        self.local_sorted = tuple(sorted(self.local))
         self._target = target
 
     def __repr__(self):
@@ -72,42 +87,78 @@ class Source:
 
     @staticmethod
     def parse(filename: str, prefix: str = "", target: Optional[str] = None):
-        local = set()
         with open(filename) as fh:
-            for line in fh:
-                m = Source.re_local.search(line)
-                if m is not None:
-                    local.add(os.path.join(prefix, m.group(1)))
+            data = fh.read()
+        local = {os.path.join(prefix, m) for m in Source.re_local.findall(data)}
 
         return Source(filename, local, target=target)
 
 
-def find_local_sources(filename: str) -> Dict[str, Source]:
+re_header = re.compile(r"\.h(pp)?$")
+
+
+def find_local_sources(filename: str, jobs: int = 1) -> Dict[str, Source]:
     main = Source.parse(filename)
     sources = {filename: main}
+    seen = set(main.local)
     local_sources = set(main.local)
-    while local_sources:
-        header = local_sources.pop()
-        dirname = os.path.dirname(header)
-        cpp = re.sub(r"\.h(pp)?$", ".cpp", header)
-        cc = re.sub(r"\.h(pp)?$", ".cc", header)
-        if cpp in sources or cc in sources:
-            continue
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        while local_sources:
+            pairs: Dict[str, str] = {}
+            for header in local_sources:
+                if header.endswith((".h", ".hpp")):
+                    root = re_header.sub("", header)
+                    cpp, cc = f"{root}.cpp", f"{root}.cc"
+                else:
+                    # Other includes (.hh, .inl, ...) are followed through themselves
+                    cpp = cc = header
+                if cpp in sources or cc in sources:
+                    continue
+
+                if os.path.exists(cpp):
+                    filename = cpp
+                elif os.path.exists(cc):
+                    filename = cc
+                else:
+                    continue
+
+                pairs.setdefault(filename, header)
+
+            headers = list(pairs.values())
+            hdrs = ex.map(lambda fn: Source.parse(fn, prefix=os.path.dirname(fn)), headers)
+            srcs = ex.map(lambda fn, hdr: Source.parse(fn, prefix=os.path.dirname(hdr)), pairs.keys(), headers)
+
+            local_sources = set()
+            for hdr, src in zip(hdrs, srcs):
+                local_sources.update(hdr.local)
+                local_sources.update(src.local)
+                sources[src.filename] = src
+
+            local_sources -= seen
+            seen.update(local_sources)
 
-        if os.path.exists(cpp):
-            filename = cpp
-        elif os.path.exists(cc):
-            filename = cc
-        else:
-            continue
+    return sources
 
-        hdr = Source.parse(header, prefix=dirname)
-        src = Source.parse(filename, prefix=dirname)
-        local_sources.update(hdr.local)
-        local_sources.update(src.local)
-        sources[filename] = src
 
-    return sources
+# Make rules escape spaces and '#' with backslashes and '$' as '$$'
+re_make_word = re.compile(r"(?:\\.|[^\s\\])+")
+re_make_escape = re.compile(r"\\(.)")
+
+
+def find_dependencies(sources: Dict[str, Source], config: Config, jobs: int = 1) -> Dict[str, Source]:
+    def deps(source: Source) -> Source:
+        if source.target() is None:
+            return source
+
+        cmd = ["g++", "-MM"] + config.cflags + [source.filename]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, encoding="utf-8", check=True)
+        _, rule = proc.stdout.replace("\\\n", " ").split(":", 1)
+        names = [re_make_escape.sub(r"\1", word).replace("$$", "$") for word in re_make_word.findall(rule)]
+        local = {os.path.normpath(fn) for fn in names} - {os.path.normpath(source.filename)}
+        return Source(source.filename, local, target=source._target)
+
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        return dict(zip(sources.keys(), ex.map(deps, sources.values())))
 
 
 def generate_makefile(sources: Dict[str, Source], out):
@@ -128,67 +179,152 @@ def generate_makefile(sources: Dict[str, Source], out):
     return "\n\n".join(lines)
 
 
-def hash_files(sources: Dict[str, Source]) -> Dict[str, bytes]:
+def _hash_one(filename: str) -> bytes:
+    with open(filename, "rb") as fh:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(fh, new_hash).digest()
+
+        m = new_hash()
+        # mmap refuses to map empty files
+        if os.fstat(fh.fileno()).st_size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                m.update(mm)
+
+        return m.digest()
+
+
+@contextlib.contextmanager
+def transaction(db):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def hash_files(db, files: Set[str], jobs: int = 1) -> Dict[str, bytes]:
+    # Files modified in the current second may change again without their
+    # mtime or size changing, so we don't remember their hashes
+    racy = int(time.time()) * 1_000_000_000
     digests = {}
+    stale = []
+    for fn in files:
+        path = os.path.abspath(fn)
+        st = os.stat(path)
+        row = db.execute(
+            "SELECT sha FROM file_hashes WHERE path = ? AND mtime = ? AND size = ?",
+            (path, st.st_mtime_ns, st.st_size),
+        ).fetchone()
+        if row is not None:
+            digests[fn] = row[0]
+        else:
+            stale.append((fn, path, st))
 
-    for filename, source in sources.items():
-        if filename not in digests:
-            with open(filename, "rb") as fh:
-                digests[filename] = hashlib.sha256(fh.read()).digest()
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        shas = list(ex.map(_hash_one, [fn for fn, _, _ in stale]))
 
-        for fn in source.local:
-            if fn not in digests:
-                with open(fn, "rb") as fh:
-                    digests[fn] = hashlib.sha256(fh.read()).digest()
+    rows = [(path, st.st_mtime_ns, st.st_size, sha) for (_, path, st), sha in zip(stale, shas) if st.st_mtime_ns < racy]
+    if rows:
+        with transaction(db):
+            db.executemany("INSERT OR REPLACE INTO file_hashes(path, mtime, size, sha) VALUES (?, ?, ?, ?)", rows)
+
+    for (fn, _, _), sha in zip(stale, shas):
+        digests[fn] = sha
 
     return digests
 
 
 class Cache:
 
-    def __init__(self, db, file_hashes: Dict[str, bytes]):
+    def __init__(self, db, objects: str, file_hashes: Dict[str, bytes]):
         self.db = db
+        self.objects = objects
         self.file_hashes = file_hashes
 
     def digest(self, source: Source, config: Config) -> bytes:
-        m = hashlib.sha256()
-        m.update(self.file_hashes[source.filename])
-        m.update(config.hash())
-        for fn in sorted(source.local):
-            m.update(self.file_hashes[fn])
-
-        return m.digest()
-
-    def lookup(self, key) -> Optional[Tuple[int, bytes]]:
-        row = self.db.execute("SELECT id, value FROM builds WHERE key = ?", (key,)).fetchone()
+        buf = b"".join(
+            [
+                self.file_hashes[source.filename],
+                config.hash(),
+                *[self.file_hashes[fn] for fn in source.local_sorted],
+            ]
+        )
+        return new_hash(buf).digest()
+
+    def path(self, sha: bytes) -> str:
+        name = sha.hex()
+        return os.path.join(self.objects, name[:2], name)
+
+    def lookup(self, key) -> Optional[str]:
+        row = self.db.execute("SELECT obj_sha FROM builds WHERE key = ?", (key,)).fetchone()
         if row is None:
             return None
 
-        _id, val = (row[0], row[1])
-        now = int(time.time())
-        with self.db as db:
-            db.execute(
-                "UPDATE builds SET last_used = ? WHERE id = ?",
-                (now, _id),
-            )
+        path = self.path(row[0])
+        if not os.path.exists(path):
+            return None
 
-        return (_id, val)
+        return path
 
-    def insert(self, key: bytes, val: bytes):
-        with self.db as db:
-            db.execute("INSERT INTO builds(key, value) VALUES (?, ?)", (key, val))
+    def touch(self, keys: List[bytes]):
+        now = int(time.time())
+        self.db.executemany(
+            "UPDATE builds SET last_used = ? WHERE key = ?",
+            [(now, key) for key in keys],
+        )
+
+    def store(self, filename: str) -> bytes:
+        sha = _hash_one(filename)
+        path = self.path(sha)
+        if not os.path.exists(path):
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            try:
+                os.link(filename, path)
+            except FileExistsError:
+                pass
+            except OSError:
+                fd, tmp = tempfile.mkstemp(dir=dirname)
+                os.close(fd)
+                shutil.copyfile(filename, tmp)
+                os.replace(tmp, path)
+
+        return sha
+
+    def insert(self, rows: List[Tuple[bytes, bytes]]):
+        now = int(time.time())
+        self.db.executemany(
+            "INSERT OR REPLACE INTO builds(key, obj_sha, last_used) VALUES (?, ?, ?)",
+            [(key, sha, now) for key, sha in rows],
+        )
 
 
-def make(task):
+def compile_object(task: Tuple[str, bytes, List[str]]) -> Tuple[str, bytes]:
     outfile, key, args = task
     logging.info(f"building {outfile}")
-    proc = subprocess.run(args, stdout=subprocess.PIPE, encoding="utf-8", check=True)
-    with open(outfile, "rb") as fh:
-        val = fh.read()
-    if proc.stderr:
-        logging.warning(proc.stderr)
+    subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+    return (outfile, key)
+
+
+def make(tasks: List[Tuple[str, bytes, List[str]]], jobs: int) -> Iterator[Tuple[str, bytes]]:
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        futures = [ex.submit(compile_object, task) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Don't start new compiles once one has failed
+            for future in futures:
+                future.cancel()
 
-    return (outfile, key, val)
+
+def install(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
 
 def get_filename(filename: Optional[str]) -> str:
@@ -200,6 +336,46 @@ def get_filename(filename: Optional[str]) -> str:
     return os.path.join(xdg_cache, "cbs.db")
 
 
+def get_objects_dir(filename: str) -> str:
+    root, _ = os.path.splitext(filename)
+    return f"{root}-objects"
+
+
+def migrate(db, objects: str):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version >= schema_version:
+        return
+
+    if version < 2:
+        # Older caches stored whole objects in the builds table, or used SHA-256
+        # digests, so nothing in them can be reused
+        db.executescript(
+            """
+            DROP TABLE IF EXISTS builds;
+            DROP TABLE IF EXISTS file_hashes;
+            """
+        )
+        shutil.rmtree(objects, ignore_errors=True)
+    elif version < 3:
+        # Version 2 kept builds in a rowid table
+        db.executescript(
+            """
+            BEGIN IMMEDIATE;
+            CREATE TABLE builds_new (
+              key BLOB PRIMARY KEY
+              , obj_sha BLOB NOT NULL
+              , last_used INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+            ) WITHOUT ROWID;
+            INSERT INTO builds_new SELECT key, obj_sha, last_used FROM builds;
+            DROP TABLE builds;
+            ALTER TABLE builds_new RENAME TO builds;
+            COMMIT;
+            """
+        )
+
+    db.execute(f"PRAGMA user_version = {schema_version}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--cache", help="Build cache")
@@ -212,25 +388,36 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO)
 
-    db = sqlite3.connect(get_filename(args.cache))
-    with db as db:
-        db.execute(schema)
+    cache_file = get_filename(args.cache)
+    db = sqlite3.connect(cache_file, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-65536")
+    db.execute("PRAGMA busy_timeout=5000")
+    migrate(db, get_objects_dir(cache_file))
+    db.executescript(schema)
 
     config = Config()
     if args.config:
         with open(args.config) as fh:
             config = Config(**json.load(fh))
 
-    sources = find_local_sources(args.source)
+    sources = find_local_sources(args.source, jobs=args.jobs)
     if args.makefile:
         print(generate_makefile(sources, out=args.binary))
         sys.exit(0)
 
-    cache = Cache(db, hash_files(sources))
+    # The compiler knows exactly which headers each translation unit uses
+    sources = find_dependencies(sources, config, jobs=args.jobs)
+    all_files = set().union(*[{s.filename} | s.local for s in sources.values()])
+    cache = Cache(db, get_objects_dir(cache_file), hash_files(db, all_files, jobs=args.jobs))
 
+    launcher = ["ccache"] if shutil.which("ccache") else []
     build = tempfile.TemporaryDirectory()
     objects = []
     tasks = []
+    used = []
     for source in sources.values():
         obj = source.target()
         if obj is None:
@@ -240,24 +427,25 @@ if __name__ == "__main__":
         outfile = os.path.join(build.name, obj)
         dirname = os.path.dirname(outfile)
         os.makedirs(dirname, exist_ok=True)
+        # Link in source order so the binary doesn't depend on compile timing
+        objects.append(outfile)
 
         res = cache.lookup(key)
         if res is not None:
             logging.info(f"{outfile} in cache")
-            _id, val = res
-            with open(outfile, "wb") as f:
-                f.write(val)
-            objects.append(outfile)
+            used.append(key)
+            install(res, outfile)
         else:
-            cmd = ["g++", "-c"] + config.cflags + ["-o", outfile, source.filename]
+            cmd = launcher + ["g++", "-c"] + config.cflags + ["-o", outfile, source.filename]
             tasks.append((outfile, key, cmd))
 
-    with multiprocessing.Pool(processes=args.jobs) as pool:
-        results = pool.map(make, tasks)
+    rows = []
+    for outfile, key in make(tasks, args.jobs):
+        rows.append((key, cache.store(outfile)))
 
-    for outfile, key, val in results:
-        cache.insert(key, val)
-        objects.append(outfile)
+    with transaction(db):
+        cache.touch(used)
+        cache.insert(rows)
 
     cmd = ["g++"] + config.cflags + config.ldflags + ["-o", args.binary] + objects
     proc = subprocess.run(cmd, stdout=subprocess.PIPE, encoding="utf-8", check=True)